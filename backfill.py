@@ -0,0 +1,363 @@
+import argparse
+import configparser
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
+from functools import partial
+
+from etl import setup_db_connection, set_query_group, load_run_state, save_run_state
+from sql_queries import (
+    staging_events_shard_create,
+    staging_events_shard_drop,
+    staging_events_shard_copy,
+    songplay_table_incremental_insert_template,
+    time_table_incremental_insert_template,
+    user_table_insert_missing_template,
+    ETL_QUERY_GROUP,
+)
+from s3_utils import s3_client, split_s3_url
+
+
+def initialize_config(config_file, credentials_file):
+    """ Read the backfill configuration and AWS credentials
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    credentials = configparser.ConfigParser()
+    credentials.read(credentials_file)
+
+    return {
+        "KEY":          credentials.get("AWS", "KEY"),
+        "SECRET":       credentials.get("AWS", "SECRET"),
+        "LOG_DATA":     config.get("S3", "LOG_DATA").strip("'"),
+        "STATE_FILE":   config.get("BACKFILL", "STATE_FILE"),
+        "CHUNK_DAYS":   config.getint("BACKFILL", "CHUNK_DAYS"),
+        "WORKERS":      config.getint("BACKFILL", "WORKERS"),
+        "RETRIES":      config.getint("BACKFILL", "RETRIES"),
+    }
+
+
+def split_date_range(start, end, chunk_days):
+    """ Split the [start, end] date range into chunks of chunk_days days
+
+        Args:
+        * start: first date of the range
+        * end: last date of the range (included)
+        * chunk_days: number of days per chunk
+
+        Returns a list of (first day, last day) tuples
+    """
+    chunks = []
+    first = start
+    while first <= end:
+        last = min(first + timedelta(days=chunk_days - 1), end)
+        chunks.append((first, last))
+        first = last + timedelta(days=1)
+    return chunks
+
+
+def chunk_name(chunk):
+    """ Identifier of a chunk, also used to name its staging shard
+    """
+    first, last = chunk
+    return f"{first:%Y%m%d}_{last:%Y%m%d}"
+
+
+def day_prefix(log_data, day):
+    """ S3 prefix of the event files for one day, following the
+        log_data/<year>/<month>/<year>-<month>-<day>-events.json layout
+    """
+    return f"{log_data}/{day:%Y}/{day:%m}/{day:%Y-%m-%d}-events"
+
+
+def epoch_ms(day):
+    """ Milliseconds since epoch at the start of a day (UTC)
+    """
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def existing_days(s3, CFG, chunk):
+    """ List the days of a chunk that have event files in S3, since
+        a COPY from a prefix without any file fails
+
+        Args:
+        * s3: boto3 client for S3
+        * CFG: the backfill configuration
+        * chunk: the (first day, last day) of the chunk
+    """
+    first, last = chunk
+    days = []
+    day = first
+    while day <= last:
+        bucket, prefix = split_s3_url(day_prefix(CFG["LOG_DATA"], day))
+        if s3.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1).get("KeyCount", 0):
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def retry(func, retries, description):
+    """ Call func, retrying it up to `retries` times on failure.
+        The last error is raised once the retries are exhausted.
+
+        Returns (result of func, number of attempts)
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            return func(), attempts
+        except Exception as e:
+            print(f"{description} attempt {attempts} failed: {e}")
+            if attempts > retries:
+                raise
+
+
+def load_shard(CFG, chunk, days):
+    """ COPY the event files of a chunk into its own staging shard.
+        Runs in a worker thread, with its own connection.
+
+        Args:
+        * CFG: the backfill configuration
+        * chunk: the (first day, last day) of the chunk
+        * days: the days of the chunk that have event files
+
+        Returns the name of the shard
+    """
+    shard = "staging_events_" + chunk_name(chunk)
+
+    conn = setup_db_connection()
+    try:
+        cur = conn.cursor()
+        set_query_group(cur, ETL_QUERY_GROUP, "backfill_" + chunk_name(chunk))
+
+        # Start from an empty shard so that a retried chunk is not loaded twice
+        cur.execute(staging_events_shard_drop.format(shard))
+        cur.execute(staging_events_shard_create.format(shard))
+
+        for day in days:
+            cur.execute(staging_events_shard_copy(shard, day_prefix(CFG["LOG_DATA"], day)))
+    finally:
+        conn.close()
+
+    return shard
+
+
+def transform_chunk(cur, chunk, shard):
+    """ Append the songplays and time rows of a loaded shard into the main
+        tables in one transaction. Only the driver runs transforms, one at
+        a time, so they never compete for the main tables write locks.
+
+        Args:
+        * cur: the cursor to the driver connection, in autocommit mode
+        * chunk: the (first day, last day) of the chunk
+        * shard: the staging shard of the chunk
+    """
+    first, last = chunk
+    params = {"min_ts": epoch_ms(first),
+              "max_ts": epoch_ms(last + timedelta(days=1)) - 1}
+
+    cur.execute("BEGIN")
+    try:
+        cur.execute(songplay_table_incremental_insert_template.format(shard), params)
+        cur.execute(time_table_incremental_insert_template.format(shard), params)
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+
+def merge_users(cur, shards):
+    """ Add the users of the shards missing from the users dimension, from
+        their latest event across all the shards, then drop the shards.
+        The users already loaded are kept, as their data is usually more
+        recent than the backfilled range.
+
+        Args:
+        * cur: the cursor to the driver connection, in autocommit mode
+        * shards: list of the staging shards of the backfill
+    """
+    events = "({})".format(" UNION ALL ".join(f"SELECT * FROM {shard}" for shard in shards))
+    cur.execute(user_table_insert_missing_template.format(events + " AS e"))
+
+    for shard in shards:
+        cur.execute(staging_events_shard_drop.format(shard))
+
+
+def backfill(CFG, start, end, chunk_days, workers, retries, restart=False):
+    """ Backfill the songplay, time and users tables over a date range.
+        The chunks are COPYed into their staging shards in parallel with
+        bounded concurrency, and each loaded shard is then transformed into
+        the main tables by the driver, one at a time. Chunk progress is
+        recorded in the backfill state file so a rerun only redoes the
+        work that didn't complete.
+
+        Args:
+        * CFG: the backfill configuration
+        * start: first date of the range
+        * end: last date of the range (included)
+        * chunk_days: number of days per chunk
+        * workers: maximum number of chunks COPYed concurrently
+        * retries: number of retries of a failed COPY or transform
+        * restart: ignore the progress of previous runs
+
+        Returns True if all the chunks completed.
+    """
+    state = {"chunks": {}} if restart else load_run_state(CFG["STATE_FILE"], empty={"chunks": {}})
+
+    def status(chunk):
+        return state["chunks"].get(chunk_name(chunk), {}).get("status")
+
+    def record(chunk, **result):
+        state["chunks"].setdefault(chunk_name(chunk), {}).update(result)
+        save_run_state(CFG["STATE_FILE"], state)
+
+    chunks = split_date_range(start, end, chunk_days)
+    loaded = [chunk for chunk in chunks if status(chunk) == "loaded"]
+    to_load = [chunk for chunk in chunks if status(chunk) not in ("done", "loaded")]
+
+    print(f"=== Backfill {start} to {end}: {len(chunks)} chunks, "
+          f"{len(chunks) - len(loaded) - len(to_load)} already done, "
+          f"{len(loaded)} already loaded")
+
+    started = time.time()
+    progress = {"done": len(chunks) - len(loaded) - len(to_load)}
+
+    def transform(cur, chunk):
+        shard = state["chunks"][chunk_name(chunk)]["shard"]
+        transform_started = time.time()
+        try:
+            _, attempts = retry(lambda: transform_chunk(cur, chunk, shard),
+                                retries,
+                                f"Transform of chunk {chunk_name(chunk)}")
+        except Exception as e:
+            # the shard stays loaded, a rerun only redoes the transform
+            record(chunk, error=str(e))
+            print(f"chunk {chunk_name(chunk)} transform failed")
+            return
+
+        progress["done"] += 1
+        record(chunk, status="done", error=None,
+               transform_attempts=attempts,
+               transform_s=round(time.time() - transform_started, 3))
+        result = state["chunks"][chunk_name(chunk)]
+        print(f"[{progress['done']}/{len(chunks)}] chunk {chunk_name(chunk)} done "
+              f"(copy {result.get('copy_s')}s, transform {result['transform_s']}s)")
+
+    s3 = s3_client(CFG)
+    conn = setup_db_connection()
+    try:
+        cur = conn.cursor()
+        set_query_group(cur, ETL_QUERY_GROUP, "backfill_transform")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for chunk in to_load:
+                days = existing_days(s3, CFG, chunk)
+                if not days:
+                    progress["done"] += 1
+                    record(chunk, status="done", shard=None, days=0)
+                    print(f"[{progress['done']}/{len(chunks)}] chunk {chunk_name(chunk)} "
+                          f"has no event files, skipped")
+                    continue
+
+                copy = partial(load_shard, CFG, chunk, days)
+                future = executor.submit(retry, copy, retries, f"COPY of chunk {chunk_name(chunk)}")
+                futures[future] = (chunk, len(days), time.time())
+
+            # shards loaded by a previous run only need their transform
+            for chunk in loaded:
+                transform(cur, chunk)
+
+            for future in as_completed(futures):
+                chunk, days, copy_started = futures[future]
+                try:
+                    shard, attempts = future.result()
+                except Exception as e:
+                    record(chunk, status="failed", error=str(e))
+                    print(f"chunk {chunk_name(chunk)} COPY failed")
+                    continue
+
+                record(chunk, status="loaded", shard=shard, days=days,
+                       copy_attempts=attempts,
+                       copy_s=round(time.time() - copy_started, 3))
+                transform(cur, chunk)
+
+        failed = [chunk_name(chunk) for chunk in chunks if status(chunk) != "done"]
+        if failed:
+            print(f"{len(failed)} chunks failed: {failed}. Rerun the backfill to retry them.")
+            return False
+
+        shards = [state["chunks"][chunk_name(chunk)]["shard"] for chunk in chunks]
+        shards = [shard for shard in shards if shard is not None]
+        if shards:
+            print("=== Merging users...")
+            merge_users(cur, shards)
+    finally:
+        conn.close()
+
+    # The shards are gone, a new backfill of this range starts from scratch
+    for chunk in chunks:
+        del state["chunks"][chunk_name(chunk)]
+    save_run_state(CFG["STATE_FILE"], state)
+
+    print(f"Backfilled {len(chunks)} chunks in {time.time() - started:.1f}s")
+    return True
+
+
+def argparser(CFG):
+    """ Command Line parser for the script
+    """
+
+    parser = argparse.ArgumentParser(description='Chunked parallel backfill of the event data')
+    parser.add_argument('--start',
+                        type=date.fromisoformat,
+                        required=True,
+                        help='first day to backfill, YYYY-MM-DD'
+                        )
+    parser.add_argument('--end',
+                        type=date.fromisoformat,
+                        required=True,
+                        help='last day to backfill (included), YYYY-MM-DD'
+                        )
+    parser.add_argument('--chunk-days',
+                        type=int,
+                        default=CFG["CHUNK_DAYS"]
+                        )
+    parser.add_argument('--workers',
+                        type=int,
+                        default=CFG["WORKERS"]
+                        )
+    parser.add_argument('--retries',
+                        type=int,
+                        default=CFG["RETRIES"]
+                        )
+    parser.add_argument('--restart',
+                        action='store_true',
+                        help='ignore the progress of previous runs'
+                        )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """ Main entrypoint for the script
+    """
+    CFG = initialize_config('dwh.cfg', 'aws.cfg')
+    args = argparser(CFG)
+
+    success = backfill(CFG,
+                       args.start,
+                       args.end,
+                       chunk_days=args.chunk_days,
+                       workers=args.workers,
+                       retries=args.retries,
+                       restart=args.restart)
+
+    print("Done!" if success else "Failed!")
+
+if __name__ == "__main__":
+    main()
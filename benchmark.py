@@ -0,0 +1,304 @@
+import argparse
+import configparser
+import statistics
+import time
+
+import pandas as pd
+import sqlparse
+
+from etl import setup_db_connection, set_query_group
+from sql_queries import (
+    wide_benchmark_queries,
+    copy_profiles,
+    copy_query,
+    EVENTS_JSONPATHS_URL,
+    ETL_QUERY_GROUP,
+    ANALYTICS_QUERY_GROUP,
+)
+
+# Staging tables loaded by the COPY benchmark, with their json format
+COPY_BENCHMARK_TABLES = (
+    ("staging_events", "EVENTS_SOURCE", EVENTS_JSONPATHS_URL),
+    ("staging_songs", "SONGS_SOURCE", "auto"),
+)
+
+# Local stand-in for the Redshift COPY grammar, after the COPY parameters
+# reference: parameter -> (accepts AS, argument, argument is optional).
+# The argument is None for a flag, "string" for a quoted literal, "number"
+# for an integer, or a tuple of the accepted keywords.
+COPY_GRAMMAR = {
+    "CREDENTIALS":      (True, "string", False),
+    "IAM_ROLE":         (False, "string", False),
+    "JSON":             (True, "string", True),
+    "REGION":           (True, "string", False),
+    "MANIFEST":         (False, None, False),
+    "COMPUPDATE":       (False, ("PRESET", "ON", "TRUE", "OFF", "FALSE"), True),
+    "STATUPDATE":       (False, ("ON", "TRUE", "OFF", "FALSE"), True),
+    "COMPROWS":         (False, "number", False),
+    "MAXERROR":         (True, "number", False),
+    "TIMEFORMAT":       (True, "string", False),
+    "DATEFORMAT":       (True, "string", False),
+    "GZIP":             (False, None, False),
+    "BZIP2":            (False, None, False),
+    "LZOP":             (False, None, False),
+    "ZSTD":             (False, None, False),
+    "TRUNCATECOLUMNS":  (False, None, False),
+    "BLANKSASNULL":     (False, None, False),
+    "EMPTYASNULL":      (False, None, False),
+    "ACCEPTANYDATE":    (False, None, False),
+    "ACCEPTINVCHARS":   (True, "string", True),
+    "FILLRECORD":       (False, None, False),
+    "IGNOREBLANKLINES": (False, None, False),
+    "ROUNDEC":          (False, None, False),
+    "NOLOAD":           (False, None, False),
+}
+
+# Parameters every staging COPY sets, whatever its profile
+COPY_COMMON_PARAMETERS = ("CREDENTIALS", "IAM_ROLE", "JSON", "REGION", "MANIFEST")
+
+# Expected profile options of the rendered COPYs, kept by hand so that a
+# change of a profile or of its rendering has to be reflected here
+EXPECTED_COPY_OPTIONS = {
+    "default":      "",
+    "fast-reload":  "COMPUPDATE OFF STATUPDATE OFF",
+    "tolerant":     "COMPUPDATE OFF STATUPDATE OFF MAXERROR 100 TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL",
+}
+
+
+def time_query(cur, query, runs):
+    """ Run a query several times and return the median duration in seconds
+
+        Args:
+        * cur: the cursor to the db connection
+        * query: the query to time
+        * runs: number of runs
+    """
+    durations = []
+    for _ in range(runs):
+        started = time.time()
+        cur.execute(query)
+        cur.fetchall()
+        durations.append(time.time() - started)
+    return statistics.median(durations)
+
+
+def benchmark_wide(cur, runs):
+    """ Compare join-heavy queries on the star schema with the same
+        questions answered by the songplay_wide table
+
+        Args:
+        * cur: the cursor to the db connection
+        * runs: number of runs of each query
+    """
+    print("=== Benchmarking star schema vs songplay_wide...")
+
+    # Make sure every run actually executes the query
+    cur.execute("SET enable_result_cache_for_session TO off")
+
+    results = []
+    for name, star_query, wide_query in wide_benchmark_queries:
+        star_s = time_query(cur, star_query, runs)
+        wide_s = time_query(cur, wide_query, runs)
+        results.append((name, round(star_s, 3), round(wide_s, 3), round(star_s / wide_s, 2)))
+
+    print(pd.DataFrame(results, columns=["query", "star_s", "wide_s", "speedup"]))
+
+
+def parse_copy_query(query):
+    """ Parse a COPY statement with the COPY_GRAMMAR stand-in, independently
+        of how it was rendered: COPY <table> FROM '<source>' followed by
+        known parameters, each at most once and with a valid argument.
+
+        Args:
+        * query: the COPY statement
+
+        Returns (table, list of (parameter, argument or None))
+    """
+    statements = [statement for statement in sqlparse.parse(query)
+                  if statement.token_first() is not None]
+    if len(statements) != 1:
+        raise ValueError(f"Expected a single statement, got {len(statements)}")
+
+    tokens = [token for token in statements[0].flatten() if not token.is_whitespace]
+    values = [token.value.upper() for token in tokens]
+
+    if any(token.ttype in sqlparse.tokens.Error for token in tokens):
+        raise ValueError("Unbalanced quotes")
+    if values[-1] != ";":
+        raise ValueError("Missing ';' at the end of the statement")
+    if len(values) < 5 or values[0] != "COPY" or values[2] != "FROM" \
+            or tokens[3].ttype not in sqlparse.tokens.String.Single:
+        raise ValueError(f"Not a COPY <table> FROM '<source>': {' '.join(values[:4])}")
+
+    parameters = []
+    position = 4
+    end = len(values) - 1
+    while position < end:
+        name = values[position]
+        position += 1
+        if name == "FORMAT":
+            if position < end and values[position] == "AS":
+                position += 1
+            name = values[position] if position < end else ""
+            position += 1
+            if name != "JSON":
+                raise ValueError(f"Unsupported COPY format {name}")
+        if name not in COPY_GRAMMAR:
+            raise ValueError(f"Unknown COPY parameter {tokens[position - 1].value}")
+        if name in dict(parameters):
+            raise ValueError(f"COPY parameter {name} is given twice")
+
+        accepts_as, argument, optional = COPY_GRAMMAR[name]
+        if accepts_as and position < end and values[position] == "AS":
+            position += 1
+
+        value = None
+        if argument is not None and position < end:
+            token = tokens[position]
+            if (argument == "string" and token.ttype in sqlparse.tokens.String.Single) \
+                    or (argument == "number" and token.ttype in sqlparse.tokens.Number.Integer) \
+                    or (isinstance(argument, tuple) and values[position] in argument):
+                value = token.value
+                position += 1
+        if argument is not None and value is None and not optional:
+            raise ValueError(f"COPY parameter {name} expects a {argument} argument")
+
+        parameters.append((name, value))
+
+    return tokens[1].value, parameters
+
+
+def check_copy_query(query, table, profile, manifest=False):
+    """ Check a rendered COPY locally, without a cluster: it must parse
+        with the COPY grammar stand-in as a COPY of the given table, with
+        its authorization, json and region, and the options of its
+        profile must be the EXPECTED_COPY_OPTIONS of the profile.
+
+        Args:
+        * query: the rendered COPY statement
+        * table: the table the COPY should load
+        * profile: the name of the COPY profile used to render it
+        * manifest: whether the COPY should read a manifest
+    """
+    if profile not in EXPECTED_COPY_OPTIONS:
+        raise ValueError(f"No EXPECTED_COPY_OPTIONS for profile {profile}")
+
+    copy_table, parameters = parse_copy_query(query)
+    names = [name for name, _ in parameters]
+
+    if copy_table.lower() != table.lower():
+        raise ValueError(f"Not a COPY into {table}: {copy_table}")
+    if ("CREDENTIALS" in names) == ("IAM_ROLE" in names):
+        raise ValueError(f"COPY of profile {profile} needs one of CREDENTIALS or IAM_ROLE")
+    for name in ("JSON", "REGION"):
+        if name not in names:
+            raise ValueError(f"Missing {name} in COPY of profile {profile}")
+    if ("MANIFEST" in names) != manifest:
+        raise ValueError(f"MANIFEST {'missing from' if manifest else 'unexpected in'} "
+                         f"COPY of profile {profile}")
+
+    options = " ".join(name if value is None else f"{name} {value}"
+                       for name, value in parameters
+                       if name not in COPY_COMMON_PARAMETERS)
+    if options.upper() != EXPECTED_COPY_OPTIONS[profile].upper():
+        raise ValueError(f"Options of COPY of profile {profile} are '{options}', "
+                         f"expected '{EXPECTED_COPY_OPTIONS[profile]}'")
+
+
+def check_copy_profiles(config, profiles):
+    """ Render the COPY of each staging table with each profile and check it
+    """
+    print("=== Checking COPY profiles...")
+    for profile in profiles:
+        for table, source, json_format in COPY_BENCHMARK_TABLES:
+            check_copy_query(copy_query(table, config.get("BENCHMARK", source), json_format, profile),
+                             table,
+                             profile)
+        print(f"{profile}: OK")
+
+
+def benchmark_copy(cur, config, profiles, runs):
+    """ Load the same input files into the staging tables with each COPY
+        profile and compare the load time and throughput.
+        The staging tables are truncated before each load.
+
+        Args:
+        * cur: the cursor to the db connection
+        * config: the project configuration
+        * profiles: names of the COPY profiles to compare
+        * runs: number of loads per profile and table
+    """
+    check_copy_profiles(config, profiles)
+
+    print("=== Benchmarking COPY profiles...")
+    results = []
+    for profile in profiles:
+        for table, source, json_format in COPY_BENCHMARK_TABLES:
+            query = copy_query(table, config.get("BENCHMARK", source), json_format, profile)
+
+            durations = []
+            for _ in range(runs):
+                cur.execute(f"TRUNCATE {table}")
+                started = time.time()
+                cur.execute(query)
+                durations.append(time.time() - started)
+
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            rows = cur.fetchone()[0]
+            load_s = statistics.median(durations)
+            results.append((profile, table, rows, round(load_s, 3), round(rows / load_s)))
+
+    print(pd.DataFrame(results, columns=["profile", "table", "rows", "load_s", "rows_per_s"]))
+
+
+def argparser(config):
+    """ Command Line parser for the script
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the data warehouse')
+    parser.add_argument('--cmd',
+                        type=str,
+                        required=True,
+                        choices=["wide", "copy", "check-copy"]
+                        )
+    parser.add_argument('--profiles',
+                        type=lambda value: value.split(","),
+                        default=copy_profiles(),
+                        help='comma separated COPY profiles to compare'
+                        )
+    parser.add_argument('--runs',
+                        type=int,
+                        default=config.getint("BENCHMARK", "RUNS")
+                        )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """ Main entrypoint for the script
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    args = argparser(config)
+
+    if args.cmd == "check-copy":
+        check_copy_profiles(config, args.profiles)
+        return
+
+    conn = setup_db_connection()
+    cur = conn.cursor()
+
+    if args.cmd == "wide":
+        set_query_group(cur, ANALYTICS_QUERY_GROUP, "benchmark_wide")
+        benchmark_wide(cur, args.runs)
+    elif args.cmd == "copy":
+        set_query_group(cur, ETL_QUERY_GROUP, "benchmark_copy")
+        benchmark_copy(cur, config, args.profiles, args.runs)
+
+    conn.close()
+    print("Done!")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,18 @@
+import argparse
 import configparser
 import psycopg2
 import sqlparse
 import json
+import os
 
 from sql_queries import (
     create_table_queries, 
     drop_table_queries,
     copy_table_queries,
     insert_table_queries,
+    songplay_wide_table_create,
 )
+from shadow_tables import truncate_staging_tables
 
 
 def drop_tables(cur):
@@ -25,20 +29,63 @@ def drop_tables(cur):
             print(e)
 
 
-def create_tables(cur):
+def clear_run_state(state_file):
+    """ Delete the ETL run-state file, whose completed stages refer
+        to the tables that were just dropped.
+
+    Args:
+        * state_file: path to the json run-state file
+    """
+    if os.path.exists(state_file):
+        os.remove(state_file)
+        print(f"Cleared ETL run state {state_file}")
+
+
+def create_tables(cur, queries=create_table_queries):
     """ Create all the tables needed for the data warehouse
 
     Args:
         * cur: the cursor to the db connection
+        * queries: the CREATE TABLE queries to run
     """
     print("=== Creating Tables...")
-    for query in create_table_queries:
+    for query in queries:
         try:
             cur.execute(query)
         except Exception as e:
             print(e)
 
 
+# Columns of staging_events, in the order the jsonpaths map them
+EVENTS_JSONPATHS = [
+    "$['artist']",
+    "$['auth']",
+    "$['firstName']",
+    "$['gender']",
+    "$['itemInSession']",
+    "$['lastName']",
+    "$['length']",
+    "$['level']",
+    "$['location']",
+    "$['method']",
+    "$['page']",
+    "$['registration']",
+    "$['sessionId']",
+    "$['song']",
+    "$['status']",
+    "$['ts']",
+    "$['userAgent']",
+    "$['userId']",
+]
+
+
+def jsonpath_keys(jsonpaths=EVENTS_JSONPATHS):
+    """ Return the json keys referenced by a list of jsonpaths,
+        e.g. "$['firstName']" -> "firstName"
+    """
+    return [path[len("$['"):-len("']")] for path in jsonpaths]
+
+
 def create_jsonpath():
     """ Create manifest file for reading json files from S3.
         Needed because some of the keys have capitalization which
@@ -46,26 +93,7 @@ def create_jsonpath():
     """
 
     data = {
-        "jsonpaths": [
-            "$['artist']",
-            "$['auth']",
-            "$['firstName']",
-            "$['gender']",
-            "$['itemInSession']",
-            "$['lastName']",
-            "$['length']",
-            "$['level']",
-            "$['location']",
-            "$['method']",
-            "$['page']",
-            "$['registration']",
-            "$['sessionId']",
-            "$['song']",
-            "$['status']",
-            "$['ts']",
-            "$['userAgent']",
-            "$['userId']",
-        ]
+        "jsonpaths": EVENTS_JSONPATHS
     }
 
     json.dump(data, open("events.jsonpaths", 'w+'))
@@ -90,15 +118,45 @@ def setup_db_connection():
     conn.set_session(autocommit=True)
     return conn
 
+def argparser():
+    """ Command Line parser for the script
+    """
+
+    parser = argparse.ArgumentParser(description='Create the data warehouse tables')
+    parser.add_argument('--keep',
+                        action='store_true',
+                        help='keep the existing tables, only create the missing '
+                             'ones and truncate the staging tables'
+                        )
+
+    args = parser.parse_args()
+
+    return args
+
+
 def main():
     """ Main entrypoint for the script
     """
+    args = argparser()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    queries = list(create_table_queries)
+    if config.getboolean("ETL", "BUILD_WIDE_TABLE", fallback=False):
+        queries.append(songplay_wide_table_create)
 
     conn = setup_db_connection()
     cur = conn.cursor()
 
-    drop_tables(cur)
-    create_tables(cur)
+    if not args.keep:
+        drop_tables(cur)
+        clear_run_state(config.get("ETL", "STATE_FILE", fallback="etl_state.json"))
+    create_tables(cur, queries)
+
+    if args.keep:
+        print("=== Truncating Staging Tables...")
+        truncate_staging_tables(cur)
 
     conn.close()
     print ("Done!")
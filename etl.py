@@ -1,47 +1,119 @@
+import argparse
 import configparser
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from functools import partial
+
 import psycopg2
 import pandas as pd
 
+import maintenance
+import shadow_tables
+import validate_events
 from sql_queries import (
-    copy_table_queries, 
-    insert_table_queries, 
-    tests_queries
+    copy_table_stages,
+    insert_table_stages,
+    staging_events_manifest_copy,
+    songplay_wide_table_insert,
+    songplay_wide_shadow_insert,
+    shadow_insert,
+    tests_queries,
+    set_query_group_query,
+    wlm_report_query,
+    ETL_QUERY_GROUP,
+    ANALYTICS_QUERY_GROUP,
 )
 
+# Stages running analytic queries, tagged with the analytics query group
+ANALYTICS_STAGES = ("check_tables", "run_tests")
+
 
-def load_staging_tables(cur):
-    """ Load data from S3 into the staging tables
+def execute_query(cur, query):
+    """ Run a single pipeline query, letting any error propagate
+        so the stage is not recorded as completed.
 
         Args:
         * cur: the cursor to the db connection
+        * query: the SQL statement to run
     """
-    print("=== Loading S3 files into staging tables...")
-    for query in copy_table_queries:
-        try:
-            print(query)
-            cur.execute(query)
-            print ("Success!")
+    print(query)
+    cur.execute(query)
+    print ("Success!")
 
-        except Exception as e:
-            print(e)
+
+def set_query_group(cur, query_group, label=None):
+    """ Tag the session with a query group so that WLM routes its queries
+        to the matching queue. The optional label is appended to the
+        query group to identify the queries of a stage in the system tables.
+
+        Args:
+        * cur: the cursor to the db connection
+        * query_group: the query group, e.g. ETL_QUERY_GROUP
+        * label: the name of the stage
+    """
+    tag = query_group if label is None else f"{query_group}_{label}"
+    cur.execute(set_query_group_query, (tag,))
 
 
-def insert_tables(cur):
-    """ Process the staging data and populate the fact and
-        dimension tables.
+def wlm_report(cur):
+    """ Print the queue wait and execution time of the queries of
+        each query group and label
 
         Args:
         * cur: the cursor to the db connection
     """
-    print("=== Inserting staging data into main tables...")
-    for query in insert_table_queries:
-        try:
-            print(query)
-            cur.execute(query)
-            print ("Success!")
+    print("=== WLM queue wait vs execution time...")
+    cur.execute(wlm_report_query, {"etl": ETL_QUERY_GROUP + "%",
+                                   "analytics": ANALYTICS_QUERY_GROUP + "%"})
+    print(pd.DataFrame(cur.fetchall(),
+                       columns=["label", "service_class", "queries",
+                                "queue_s", "exec_s", "max_queue_s"]))
+
+
+def fingerprint(*inputs):
+    """ Compute a fingerprint of a stage inputs. A completed stage is
+        only skipped on resume if its fingerprint hasn't changed.
+
+        Args:
+        * inputs: any values describing the work done by the stage
+    """
+    digest = hashlib.md5()
+    for value in inputs:
+        digest.update(str(value).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_run_state(state_file, empty=None):
+    """ Read the run-state file recording the completed stages
+
+        Args:
+        * state_file: path to the json run-state file
+        * empty: the state returned when the file doesn't exist yet,
+          defaults to the ETL state without any completed stage
+    """
+    if not os.path.exists(state_file):
+        return {"stages": {}} if empty is None else empty
+
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def save_run_state(state_file, state):
+    """ Atomically write the run-state file so an interrupted run
+        never leaves it half written.
+
+        Args:
+        * state_file: path to the json run-state file
+        * state: the run-state dictionary to save
+    """
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, state_file)
 
-        except Exception as e:
-            print(e)
 
 def run_tests(cur):
     """ Run test queries on the final dataset for analysis
@@ -131,28 +203,214 @@ def setup_db_connection():
     conn.set_session(autocommit=True)
     return conn
 
+def pipeline_stages(load_mode="direct"):
+    """ Build the ordered list of pipeline stages as
+        (name, fingerprint, function) tuples.
+
+        Each fingerprint is chained with the previous stage's so that
+        changing an upstream stage invalidates everything after it.
+
+        Args:
+        * load_mode: how the fact and dimension tables are loaded,
+          one of shadow_tables.LOAD_MODES
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    stages = []
+    previous = ""
+    copy_stages = copy_table_stages
+    insert_stages = insert_table_stages
+
+    # Reuse the staging tables instead of dropping them, and build
+    # the new data in shadow tables while the live ones stay queryable
+    if load_mode != "direct":
+        previous = fingerprint(previous, "truncate_staging_tables")
+        stages.append(("truncate_staging_tables", previous, shadow_tables.truncate_staging_tables))
+
+        insert_stages = [(name, shadow_insert(query)) for name, query in insert_table_stages]
+
+    # Validate the event files first and only COPY the valid ones
+    if config.getboolean("VALIDATION", "ENABLED", fallback=False):
+        validation_cfg = validate_events.initialize_config('dwh.cfg', 'aws.cfg')
+        previous = fingerprint(previous, "validate_events", validation_cfg["SOURCE"])
+        stages.append(("validate_events", previous,
+                       lambda cur: validate_events.validate_events(validation_cfg)))
+
+        copy_stages = [(name, staging_events_manifest_copy if name == "staging_events_copy" else query)
+                       for name, query in copy_table_stages]
+
+    for name, query in copy_stages:
+        previous = fingerprint(previous, query)
+        stages.append((name, previous, partial(execute_query, query=query)))
+
+    wide = config.getboolean("ETL", "BUILD_WIDE_TABLE", fallback=False)
+
+    if load_mode != "direct":
+        previous = fingerprint(previous, "create_shadow_tables", load_mode, wide)
+        stages.append(("create_shadow_tables", previous,
+                       partial(shadow_tables.create_shadow_tables, load_mode=load_mode, wide=wide)))
+
+    for name, query in insert_stages:
+        previous = fingerprint(previous, query)
+        stages.append((name, previous, partial(execute_query, query=query)))
+
+    # the swapped in songplay has new ids: the wide table is rebuilt from
+    # the shadow tables and swapped in with them
+    if wide and load_mode == "swap":
+        previous = fingerprint(previous, songplay_wide_shadow_insert)
+        stages.append(("songplay_wide_table_insert", previous,
+                       partial(execute_query, query=songplay_wide_shadow_insert)))
+
+    if load_mode != "direct":
+        previous = fingerprint(previous, "publish_shadow_tables", load_mode, wide)
+        stages.append(("publish_shadow_tables", previous,
+                       partial(shadow_tables.publish_shadow_tables, load_mode=load_mode, wide=wide)))
+
+    if wide and load_mode != "swap":
+        previous = fingerprint(previous, songplay_wide_table_insert)
+        stages.append(("songplay_wide_table_insert", previous,
+                       partial(execute_query, query=songplay_wide_table_insert)))
+
+    maintenance_cfg = maintenance.initialize_config('dwh.cfg')
+    previous = fingerprint(previous, "maintenance", maintenance_cfg)
+    stages.append(("maintenance", previous,
+                   partial(maintenance.run_maintenance, CFG=maintenance_cfg)))
+
+    previous = fingerprint(previous, "check_tables")
+    stages.append(("check_tables", previous, check_tables))
+
+    previous = fingerprint(previous, *tests_queries)
+    stages.append(("run_tests", previous, run_tests))
+
+    return stages
+
+
+def run_pipeline(cur, stages, state_file, resume=False, from_stage=None):
+    """ Run the pipeline stages in order, recording each completed stage
+        in the run-state file. Stops at the first failing stage.
+
+        Args:
+        * cur: the cursor to the db connection
+        * stages: list of (name, fingerprint, function) tuples
+        * state_file: path to the json run-state file
+        * resume: skip the stages already completed with the same fingerprint
+        * from_stage: name of the stage to restart from
+
+        Returns True if all stages completed.
+    """
+    names = [name for name, _, _ in stages]
+    if from_stage is not None and from_stage not in names:
+        raise ValueError(f"Unknown stage {from_stage}, choose from {names}")
+
+    if resume or from_stage is not None:
+        state = load_run_state(state_file)
+    else:
+        state = {"stages": {}}
+
+    start = names.index(from_stage) if from_stage is not None else 0
+
+    for i, (name, digest, func) in enumerate(stages):
+        completed = state["stages"].get(name)
+
+        if i < start:
+            print(f"=== Skipping {name} (before {from_stage})")
+            continue
+
+        if resume and completed and completed["fingerprint"] == digest:
+            print(f"=== Skipping {name} (completed {completed['completed_at']})")
+            continue
+
+        print(f"=== Stage {name}")
+        started = time.time()
+        try:
+            set_query_group(cur,
+                            ANALYTICS_QUERY_GROUP if name in ANALYTICS_STAGES else ETL_QUERY_GROUP,
+                            name)
+            func(cur)
+        except Exception as e:
+            print(e)
+            print(f"Stage {name} failed, rerun with --resume to continue from it.")
+            return False
+
+        state["stages"][name] = {
+            "fingerprint": digest,
+            "completed_at": datetime.utcnow().isoformat(),
+            "duration_s": round(time.time() - started, 3),
+        }
+        save_run_state(state_file, state)
+
+    return True
+
+
+def argparser():
+    """ Command Line parser for the script
+    """
+
+    parser = argparse.ArgumentParser(description='Sparkify ETL pipeline')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='skip the stages completed by a previous run'
+                        )
+    parser.add_argument('--from-stage',
+                        type=str,
+                        help='restart the pipeline at the given stage'
+                        )
+    parser.add_argument('--load-mode',
+                        type=str,
+                        choices=shadow_tables.LOAD_MODES,
+                        help='how the fact and dimension tables are loaded, '
+                             'defaults to LOAD_MODE in dwh.cfg'
+                        )
+    parser.add_argument('--wlm-report',
+                        action='store_true',
+                        help='only print the queue wait vs execution time per query group'
+                        )
+
+    args = parser.parse_args()
+
+    return parser, args
+
+
 def main():
     """ Main entrypoint for the script
     """
+    parser, args = argparser()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    state_file = config.get("ETL", "STATE_FILE", fallback="etl_state.json")
+    load_mode = args.load_mode or config.get("ETL", "LOAD_MODE", fallback="direct")
+    if load_mode not in shadow_tables.LOAD_MODES:
+        parser.error(f"invalid LOAD_MODE {load_mode!r} in dwh.cfg, "
+                     f"choose from {', '.join(shadow_tables.LOAD_MODES)}")
+
+    # the stages depend on the load mode, so --from-stage is checked here
+    stages = pipeline_stages(load_mode)
+    stage_names = [name for name, _, _ in stages]
+    if args.from_stage and args.from_stage not in stage_names:
+        parser.error(f"invalid --from-stage {args.from_stage!r} for the {load_mode} load mode, "
+                     f"choose from {', '.join(stage_names)}")
 
     conn = setup_db_connection()
     cur = conn.cursor()
-    
-    # 1. Load Data from S3 to Staging tables
-    load_staging_tables(cur)
-
-    # 2. Ingest staging tables into main tables
-    insert_tables(cur)
 
-    # 3. Print a sample of data for sanitation
-    check_tables(cur)
+    if args.wlm_report:
+        wlm_report(cur)
+        conn.close()
+        return
 
-    # 4. run tests
-    run_tests(cur)
+    # Load S3 into staging, ingest into the main tables, print a
+    # sample of data for sanitation and run the tests
+    success = run_pipeline(cur,
+                           stages,
+                           state_file,
+                           resume=args.resume,
+                           from_stage=args.from_stage)
 
     conn.close()
 
-    print("Done!")
+    print("Done!" if success else "Failed!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import configparser
+import time
+from datetime import datetime
+
+from etl import setup_db_connection, set_query_group, load_run_state, save_run_state
+from sql_queries import (
+    dimension_tables,
+    songplay_partitions_query,
+    songplay_partition_select,
+    dimension_select,
+    unload_query,
+    ETL_QUERY_GROUP,
+)
+from s3_utils import s3_client, split_s3_url
+
+
+def initialize_config(config_file, credentials_file):
+    """ Read the export configuration and AWS credentials
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    credentials = configparser.ConfigParser()
+    credentials.read(credentials_file)
+
+    return {
+        "KEY":              credentials.get("AWS", "KEY"),
+        "SECRET":           credentials.get("AWS", "SECRET"),
+        "DESTINATION":      config.get("EXPORT", "DESTINATION").rstrip("/"),
+        "STATE_FILE":       config.get("EXPORT", "STATE_FILE"),
+        "MAX_FILE_SIZE_MB": config.getint("EXPORT", "MAX_FILE_SIZE_MB"),
+    }
+
+
+def delete_prefix(s3, destination):
+    """ Delete every file under an S3 prefix
+
+        Args:
+        * s3: boto3 client for S3
+        * destination: the S3 prefix to empty
+    """
+    bucket, prefix = split_s3_url(destination)
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if keys:
+            s3.delete_objects(Bucket=bucket, Delete={"Objects": keys})
+
+
+def unload(cur, s3, select, destination, CFG):
+    """ UNLOAD a query result to the destination and print the time taken.
+        The destination is emptied first, as ALLOWOVERWRITE only replaces
+        the files of the same name and readers scanning the prefix would
+        count the leftovers of a previous, larger export.
+
+        Args:
+        * cur: the cursor to the db connection
+        * s3: boto3 client for S3
+        * select: the query to export
+        * destination: the S3 prefix to write the Parquet files to
+        * CFG: the export configuration
+    """
+    delete_prefix(s3, destination)
+
+    print(f"Unloading to {destination}")
+    started = time.time()
+    cur.execute(unload_query(select, destination, CFG["MAX_FILE_SIZE_MB"]))
+    print(f"Success! ({time.time() - started:.1f}s)")
+
+
+def export_songplay(cur, s3, CFG, state, full=False):
+    """ Export songplay as Parquet partitioned by year and month, in the
+        <destination>/songplay/year=<year>/month=<month>/ layout.
+        Only the new partitions, or those whose row count changed since
+        the last export, are unloaded unless a full export is requested.
+
+        Args:
+        * cur: the cursor to the db connection
+        * s3: boto3 client for S3
+        * CFG: the export configuration
+        * state: the export state, updated with the exported partitions
+        * full: export all the partitions
+    """
+    print("=== Exporting songplay...")
+    exported = state.setdefault("songplay", {})
+
+    cur.execute(songplay_partitions_query)
+    for year, month, count in cur.fetchall():
+        partition = f"year={int(year)}/month={int(month):02d}"
+
+        if not full and exported.get(partition, {}).get("rows") == count:
+            print(f"Skipping {partition}, already exported")
+            continue
+
+        # forget the partition before its files are deleted, so a failed
+        # UNLOAD is retried by the next run
+        exported.pop(partition, None)
+        save_run_state(CFG["STATE_FILE"], state)
+
+        unload(cur,
+               s3,
+               songplay_partition_select.format(int(year), int(month)),
+               f"{CFG['DESTINATION']}/songplay/{partition}/",
+               CFG)
+
+        exported[partition] = {"rows": count,
+                               "exported_at": datetime.utcnow().isoformat()}
+        save_run_state(CFG["STATE_FILE"], state)
+
+
+def export_dimensions(cur, s3, CFG, state):
+    """ Export each dimension table in full as Parquet under
+        <destination>/<table>/
+
+        Args:
+        * cur: the cursor to the db connection
+        * s3: boto3 client for S3
+        * CFG: the export configuration
+        * state: the export state, updated with the export times
+    """
+    print("=== Exporting dimensions...")
+    exported = state.setdefault("dimensions", {})
+
+    for table in dimension_tables:
+        exported.pop(table, None)
+        save_run_state(CFG["STATE_FILE"], state)
+
+        unload(cur, s3, dimension_select.format(table), f"{CFG['DESTINATION']}/{table}/", CFG)
+
+        exported[table] = {"exported_at": datetime.utcnow().isoformat()}
+        save_run_state(CFG["STATE_FILE"], state)
+
+
+def argparser():
+    """ Command Line parser for the script
+    """
+
+    parser = argparse.ArgumentParser(description='Export the star schema as Parquet files')
+    parser.add_argument('--full',
+                        action='store_true',
+                        help='export all the songplay partitions, not only the new ones'
+                        )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """ Main entrypoint for the script
+    """
+    args = argparser()
+    CFG = initialize_config('dwh.cfg', 'aws.cfg')
+    state = load_run_state(CFG["STATE_FILE"], empty={"songplay": {}, "dimensions": {}})
+    s3 = s3_client(CFG)
+
+    conn = setup_db_connection()
+    cur = conn.cursor()
+    set_query_group(cur, ETL_QUERY_GROUP, "export")
+
+    export_songplay(cur, s3, CFG, state, full=args.full)
+    export_dimensions(cur, s3, CFG, state)
+
+    conn.close()
+    print("Done!")
+
+if __name__ == "__main__":
+    main()
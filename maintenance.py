@@ -0,0 +1,87 @@
+import configparser
+import time
+
+import pandas as pd
+
+from sql_queries import (
+    maintained_tables,
+    table_info_query,
+    vacuum_sort_query,
+    vacuum_delete_query,
+    analyze_query,
+)
+
+
+def initialize_config(config_file):
+    """ Read the maintenance thresholds and time budget
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    return {
+        "UNSORTED_PCT":     config.getfloat("MAINTENANCE", "UNSORTED_PCT"),
+        "DELETED_PCT":      config.getfloat("MAINTENANCE", "DELETED_PCT"),
+        "STATS_OFF_PCT":    config.getfloat("MAINTENANCE", "STATS_OFF_PCT"),
+        "TIME_BUDGET_S":    config.getfloat("MAINTENANCE", "TIME_BUDGET_S"),
+    }
+
+
+def plan_maintenance(CFG, table_info):
+    """ Decide which tables need a VACUUM or an ANALYZE
+
+        Args:
+        * CFG: the maintenance configuration
+        * table_info: rows of (table, unsorted %, stats_off %, size MB,
+          rows, visible rows) from svv_table_info, largest tables first
+
+        Returns a list of (table, query, reason)
+    """
+    plan = []
+    for table, unsorted, stats_off, size, rows, visible_rows in table_info:
+        deleted = 100.0 * (rows - visible_rows) / rows if rows else 0
+
+        if unsorted > CFG["UNSORTED_PCT"]:
+            plan.append((table, vacuum_sort_query.format(table),
+                         f"{unsorted:.1f}% unsorted"))
+        if deleted > CFG["DELETED_PCT"]:
+            plan.append((table, vacuum_delete_query.format(table),
+                         f"{deleted:.1f}% deleted rows"))
+        if stats_off > CFG["STATS_OFF_PCT"]:
+            plan.append((table, analyze_query.format(table),
+                         f"{stats_off:.1f}% stale statistics"))
+    return plan
+
+
+def run_maintenance(cur, CFG):
+    """ VACUUM and ANALYZE the fact and dimension tables whose unsorted,
+        deleted or stale statistics percentages cross the thresholds.
+        No new operation is started once the time budget is spent.
+
+        Args:
+        * cur: the cursor to the db connection, in autocommit mode
+        * CFG: the maintenance configuration
+    """
+    print("=== Running maintenance...")
+    started = time.time()
+
+    cur.execute(table_info_query, (tuple(maintained_tables),))
+    plan = plan_maintenance(CFG, cur.fetchall())
+
+    if not plan:
+        print("All tables within thresholds, nothing to do.")
+        return
+
+    log = []
+    for table, query, reason in plan:
+        elapsed = time.time() - started
+        if elapsed > CFG["TIME_BUDGET_S"]:
+            log.append((table, query, reason, "skipped (time budget)", None))
+            continue
+
+        print(f"{query} ({reason})")
+        query_started = time.time()
+        cur.execute(query)
+        log.append((table, query, reason, "done", round(time.time() - query_started, 1)))
+
+    print(pd.DataFrame(log, columns=["table", "operation", "reason", "status", "duration_s"]))
+    print(f"Maintenance took {time.time() - started:.1f}s")
@@ -101,6 +101,15 @@ def initialize_config(config_file, credentials_file):
 
     CFG["DWH_IAM_ROLE_NAME"]      = config.get("IAM", "ROLE_NAME")
 
+    CFG["WLM_PARAMETER_GROUP"]          = config.get("WLM", "PARAMETER_GROUP")
+    CFG["WLM_ETL_QUERY_GROUP"]          = config.get("WLM", "ETL_QUERY_GROUP")
+    CFG["WLM_ETL_CONCURRENCY"]          = config.get("WLM", "ETL_CONCURRENCY")
+    CFG["WLM_ETL_MEMORY_PERCENT"]       = config.get("WLM", "ETL_MEMORY_PERCENT")
+    CFG["WLM_ANALYTICS_QUERY_GROUP"]    = config.get("WLM", "ANALYTICS_QUERY_GROUP")
+    CFG["WLM_ANALYTICS_CONCURRENCY"]    = config.get("WLM", "ANALYTICS_CONCURRENCY")
+    CFG["WLM_ANALYTICS_MEMORY_PERCENT"] = config.get("WLM", "ANALYTICS_MEMORY_PERCENT")
+    CFG["WLM_DEFAULT_CONCURRENCY"]      = config.get("WLM", "DEFAULT_CONCURRENCY")
+
     print(pd.DataFrame
             ({  "Param": ["DWH_CLUSTER_TYPE", 
                         "DWH_NUM_NODES", 
@@ -323,6 +332,83 @@ def delete_cluster(CFG, redshift, iam):
 
     print("Done!")
 
+def wlm_configuration(CFG):
+    """ Build the manual WLM configuration with one queue for the ETL
+        and one for the analytic queries, matched on their query group
+        (the pipeline appends the stage name, hence the wildcard), and
+        the default queue for everything else.
+
+    param:
+        * CFG: the config file for the project
+    """
+    return [
+        {
+            "query_group": [CFG["WLM_ETL_QUERY_GROUP"] + "*"],
+            "query_group_wild_card": 1,
+            "user_group": [],
+            "user_group_wild_card": 0,
+            "query_concurrency": int(CFG["WLM_ETL_CONCURRENCY"]),
+            "memory_percent_to_use": int(CFG["WLM_ETL_MEMORY_PERCENT"]),
+        },
+        {
+            "query_group": [CFG["WLM_ANALYTICS_QUERY_GROUP"] + "*"],
+            "query_group_wild_card": 1,
+            "user_group": [],
+            "user_group_wild_card": 0,
+            "query_concurrency": int(CFG["WLM_ANALYTICS_CONCURRENCY"]),
+            "memory_percent_to_use": int(CFG["WLM_ANALYTICS_MEMORY_PERCENT"]),
+        },
+        {
+            "query_concurrency": int(CFG["WLM_DEFAULT_CONCURRENCY"]),
+        },
+    ]
+
+
+def apply_wlm(CFG, redshift):
+    """ Apply the WLM configuration to the cluster through a dedicated
+        parameter group, created if needed.
+
+    params:
+        * CFG: the config file for the project
+        * redshift: boto3 client for redshift
+    """
+    print("=== Apply WLM Configuration")
+
+    try:
+        redshift.create_cluster_parameter_group(
+            ParameterGroupName=CFG["WLM_PARAMETER_GROUP"],
+            ParameterGroupFamily="redshift-1.0",
+            Description="Separate WLM queues for the ETL and the analytics"
+        )
+        print(f"Parameter group {CFG['WLM_PARAMETER_GROUP']} created")
+    except redshift.exceptions.ClusterParameterGroupAlreadyExistsFault:
+        print(f"Parameter group {CFG['WLM_PARAMETER_GROUP']} already exists")
+
+    wlm = wlm_configuration(CFG)
+    print(json.dumps(wlm, indent=2))
+
+    redshift.modify_cluster_parameter_group(
+        ParameterGroupName=CFG["WLM_PARAMETER_GROUP"],
+        Parameters=[{
+            "ParameterName": "wlm_json_configuration",
+            "ParameterValue": json.dumps(wlm),
+            "ApplyType": "static",
+        }]
+    )
+
+    myClusterProps = redshift.describe_clusters(
+                        ClusterIdentifier=CFG["DWH_CLUSTER_IDENTIFIER"])['Clusters'][0]
+    groups = [group["ParameterGroupName"] for group in myClusterProps["ClusterParameterGroups"]]
+
+    if CFG["WLM_PARAMETER_GROUP"] not in groups:
+        redshift.modify_cluster(ClusterIdentifier=CFG["DWH_CLUSTER_IDENTIFIER"],
+                                ClusterParameterGroupName=CFG["WLM_PARAMETER_GROUP"])
+        print("Parameter group assigned to the cluster")
+
+    print("Reboot the cluster for the WLM queues to take effect.")
+    print("Done!")
+
+
 def argparser():
     """ Command Line parser for the script
     """
@@ -331,7 +417,7 @@ def argparser():
     parser.add_argument('--cmd', 
                         type=str,
                         required=True,
-                        choices=["create", "delete", "test"]
+                        choices=["create", "delete", "wlm", "test"]
                         )
 
     args = parser.parse_args()
@@ -369,6 +455,8 @@ def main():
         create_cluster(CFG, redshift, ec2, roleArn)
     elif cmd == "delete":
         delete_cluster(CFG, redshift, iam)
+    elif cmd == "wlm":
+        apply_wlm(CFG, redshift)
  
 
 if __name__ == "__main__":
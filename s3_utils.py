@@ -0,0 +1,20 @@
+import boto3
+
+
+def s3_client(CFG):
+    """ Create a boto3 S3 client from the AWS credentials
+
+        Args:
+        * CFG: a configuration with the AWS KEY and SECRET
+    """
+    return boto3.client('s3',
+                        aws_access_key_id=CFG["KEY"],
+                        aws_secret_access_key=CFG["SECRET"],
+                        region_name="us-west-2")
+
+
+def split_s3_url(url):
+    """ Split s3://bucket/key into (bucket, key)
+    """
+    bucket, _, key = url[len("s3://"):].partition("/")
+    return bucket, key
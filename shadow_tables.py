@@ -0,0 +1,179 @@
+from sql_queries import (
+    main_table_creates,
+    staging_table_truncate_queries,
+    shadow_table_drop,
+    old_table_drop,
+    shadow_table_create,
+    songplay_next_id_query,
+    append_dedupe_queries,
+    append_table_query,
+    append_merge_queries,
+    rename_table_query,
+    table_exists_query,
+)
+
+# How the fact and dimension tables are loaded:
+# * direct: INSERT into the live tables
+# * append: build the new rows in shadow tables and move them into the
+#   live tables with ALTER TABLE APPEND
+# * swap: rebuild the tables in shadow tables and swap them in by renaming
+LOAD_MODES = ("direct", "append", "swap")
+
+MAIN_TABLES = [table for table, _ in main_table_creates]
+
+# Built from the main tables, so swapped in along with them
+WIDE_TABLE = "songplay_wide"
+
+
+def shadowed_tables(load_mode, wide=False):
+    """ The tables loaded through shadow tables in a load mode. When
+        swapping, the wide table is rebuilt from the shadow tables and
+        swapped in with them, so readers never see it empty.
+
+        Args:
+        * load_mode: append or swap
+        * wide: whether the songplay_wide table is built
+    """
+    if load_mode == "swap" and wide:
+        return MAIN_TABLES + [WIDE_TABLE]
+    return MAIN_TABLES
+
+
+def truncate_staging_tables(cur):
+    """ Empty the staging tables, keeping their definition
+
+        Args:
+        * cur: the cursor to the db connection
+    """
+    for query in staging_table_truncate_queries:
+        print(query)
+        cur.execute(query)
+
+
+def create_shadow_tables(cur, load_mode, wide=False):
+    """ (Re)create an empty shadow table for each fact and dimension table.
+        When appending, the songplay identity of the shadow table continues
+        after the live table's.
+
+        Args:
+        * cur: the cursor to the db connection
+        * load_mode: append or swap
+        * wide: whether the songplay_wide table is built
+    """
+    identity_seed = 0
+    if load_mode == "append":
+        cur.execute(songplay_next_id_query)
+        identity_seed = cur.fetchone()[0]
+
+    for table in shadowed_tables(load_mode, wide):
+        cur.execute(shadow_table_drop.format(table))
+        cur.execute(shadow_table_create(table, identity_seed))
+        print(f"Created {table}_shadow")
+
+
+def shadow_table_exists(cur, table):
+    """ Whether the shadow table of a table exists, i.e. hasn't been
+        published and dropped by a previous run of the stage
+    """
+    cur.execute(table_exists_query, (table + "_shadow",))
+    return cur.fetchone()[0] > 0
+
+
+def merge_shadow_table(cur, table):
+    """ Replace the live rows of a table with those of its shadow table in
+        a single transaction, so readers never miss a row. Merging again
+        gives the same result.
+
+        Args:
+        * cur: the cursor to the db connection, in autocommit mode
+        * table: the table to merge, with its queries in append_merge_queries
+    """
+    cur.execute("BEGIN")
+    try:
+        for query in append_merge_queries[table]:
+            cur.execute(query)
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+
+def append_shadow_tables(cur):
+    """ Move the new rows of each shadow table into its live table with
+        ALTER TABLE APPEND, which moves the data blocks instead of copying
+        them and must run outside of a transaction block. The users are
+        merged instead, as their rows are updated.
+        The shadow tables are only dropped once every table is published,
+        so a failed publish can be resumed: appending an emptied shadow
+        table or merging users again changes nothing.
+
+        Args:
+        * cur: the cursor to the db connection, in autocommit mode
+    """
+    for table in MAIN_TABLES:
+        if not shadow_table_exists(cur, table):
+            print(f"Skipping {table}, {table}_shadow is already published")
+            continue
+
+        if table in append_merge_queries:
+            merge_shadow_table(cur, table)
+            print(f"Merged {table}_shadow into {table}")
+            continue
+
+        cur.execute(append_dedupe_queries[table])
+        cur.execute(append_table_query.format(table))
+        print(f"Appended {table}_shadow to {table}")
+
+    for table in MAIN_TABLES:
+        cur.execute(shadow_table_drop.format(table))
+
+
+def swap_shadow_tables(cur, tables=MAIN_TABLES):
+    """ Replace every live table with its shadow table in a single
+        transaction, so readers see either the old or the new data.
+        A swap that committed but failed to drop the old tables is
+        completed by running it again.
+
+        Args:
+        * cur: the cursor to the db connection, in autocommit mode
+        * tables: the tables to swap in
+    """
+    # leftovers of a previous swap
+    for table in tables:
+        cur.execute(old_table_drop.format(table))
+
+    missing = [table for table in tables if not shadow_table_exists(cur, table)]
+    if len(missing) == len(tables):
+        print("Shadow tables already swapped in")
+        return
+    if missing:
+        raise ValueError(f"Missing shadow tables of {missing}, "
+                         f"rerun the pipeline from create_shadow_tables")
+
+    cur.execute("BEGIN")
+    try:
+        for table in tables:
+            cur.execute(rename_table_query.format(table, table + "_old"))
+            cur.execute(rename_table_query.format(table + "_shadow", table))
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+    for table in tables:
+        cur.execute(old_table_drop.format(table))
+        print(f"Swapped {table}_shadow in as {table}")
+
+
+def publish_shadow_tables(cur, load_mode, wide=False):
+    """ Make the shadow tables data live, according to the load mode
+
+        Args:
+        * cur: the cursor to the db connection, in autocommit mode
+        * load_mode: append or swap
+        * wide: whether the songplay_wide table is built
+    """
+    if load_mode == "append":
+        append_shadow_tables(cur)
+    else:
+        swap_shadow_tables(cur, shadowed_tables(load_mode, wide))
@@ -1,4 +1,5 @@
 import configparser
+import re
 
 
 # CONFIG
@@ -6,6 +7,14 @@ config = configparser.ConfigParser()
 config.read('cluster.cfg')
 ROLE_ARN = config.get("REDSHIFT", "dwh_role_arn")
 
+dwh_config = configparser.ConfigParser()
+dwh_config.read('dwh.cfg')
+COPY_PROFILE = dwh_config.get("ETL", "COPY_PROFILE", fallback="default")
+ETL_QUERY_GROUP = dwh_config.get("WLM", "ETL_QUERY_GROUP", fallback="etl")
+ANALYTICS_QUERY_GROUP = dwh_config.get("WLM", "ANALYTICS_QUERY_GROUP", fallback="analytics")
+
+EVENTS_JSONPATHS_URL = 's3://jazra.udacity.dataengineer/events.jsonpaths'
+
 # DROP TABLES
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
@@ -15,11 +24,12 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+songplay_wide_table_drop = "DROP TABLE IF EXISTS songplay_wide"
 
 # CREATE TABLES
 
 staging_events_table_create= ("""
-    CREATE TABLE staging_events (
+    CREATE TABLE IF NOT EXISTS staging_events (
         artist          VARCHAR(1024),
         auth            VARCHAR(1024),
         firstName       VARCHAR(1024),
@@ -38,11 +48,12 @@ staging_events_table_create= ("""
         ts              BIGINT,
         userAgent       VARCHAR(65535),
         userId          VARCHAR(1024)
-    );
+    )
+    backup no;
 """)
 
 staging_songs_table_create = ("""
-    CREATE TABLE staging_songs (
+    CREATE TABLE IF NOT EXISTS staging_songs (
         num_songs           INTEGER,
         artist_id           VARCHAR(1024),
         artist_latitude     REAL,
@@ -53,12 +64,13 @@ staging_songs_table_create = ("""
         title               VARCHAR(1024) distkey,
         duration            REAL,
         year                VARCHAR(1024)
-    );
+    )
+    backup no;
 """)
 
 
 songplay_table_create = ("""
-    CREATE TABLE songplay (
+    CREATE TABLE IF NOT EXISTS songplay (
         songplay_id     BIGINT IDENTITY(0, 1) PRIMARY KEY, 
         start_time      BIGINT NOT NULL, 
         user_id         TEXT NOT NULL DISTKEY, 
@@ -72,7 +84,7 @@ songplay_table_create = ("""
 """)
 
 user_table_create = ("""
-    CREATE TABLE users (
+    CREATE TABLE IF NOT EXISTS users (
         user_id         TEXT PRIMARY KEY DISTKEY, 
         first_name      TEXT, 
         last_name       TEXT,
@@ -83,7 +95,7 @@ user_table_create = ("""
 """)
 
 song_table_create = ("""
-    CREATE TABLE songs (
+    CREATE TABLE IF NOT EXISTS songs (
         song_id         TEXT PRIMARY KEY  DISTKEY, 
         title           TEXT, 
         artist_id       TEXT, 
@@ -94,7 +106,7 @@ song_table_create = ("""
 )
 
 artist_table_create = ("""
-    CREATE TABLE artists (
+    CREATE TABLE IF NOT EXISTS artists (
         artist_id       TEXT PRIMARY KEY, 
         name            TEXT, 
         location        TEXT, 
@@ -105,7 +117,7 @@ artist_table_create = ("""
 """)
 
 time_table_create = ("""
-    CREATE TABLE time (
+    CREATE TABLE IF NOT EXISTS time (
         start_time      BIGINT PRIMARY KEY, 
         hour            INTEGER, 
         day             INTEGER, 
@@ -117,22 +129,111 @@ time_table_create = ("""
     diststyle all;
 """)
 
+# Optional denormalized songplay, pre-joined with all the dimensions
+songplay_wide_table_create = ("""
+    CREATE TABLE IF NOT EXISTS songplay_wide (
+        songplay_id         BIGINT NOT NULL,
+        start_time          BIGINT NOT NULL,
+        hour                INTEGER,
+        day                 INTEGER,
+        week                INTEGER,
+        month               INTEGER,
+        year                INTEGER,
+        weekday             INTEGER,
+        user_id             TEXT NOT NULL DISTKEY,
+        first_name          TEXT,
+        last_name           TEXT,
+        gender              TEXT,
+        level               TEXT,
+        song_id             TEXT NOT NULL,
+        title               TEXT,
+        song_year           INTEGER,
+        duration            FLOAT,
+        artist_id           TEXT NOT NULL,
+        artist_name         TEXT,
+        artist_location     TEXT,
+        artist_latitude     FLOAT,
+        artist_longitude    FLOAT,
+        session_id          INTEGER,
+        location            TEXT,
+        user_agent          TEXT
+    )
+    sortkey (start_time);
+""")
+
 # STAGING TABLES
 
+# COPY options a profile may set, with a check of their value
+COPY_OPTIONS = {
+    "COMPUPDATE":       lambda value: value.upper() in ("ON", "OFF", "PRESET"),
+    "STATUPDATE":       lambda value: value.upper() in ("ON", "OFF"),
+    "COMPROWS":         lambda value: value.isdigit(),
+    "MAXERROR":         lambda value: value.isdigit(),
+    "TIMEFORMAT":       lambda value: value.startswith("'") and value.endswith("'"),
+    "DATEFORMAT":       lambda value: value.startswith("'") and value.endswith("'"),
+    "GZIP":             lambda value: value == "",
+    "TRUNCATECOLUMNS":  lambda value: value == "",
+    "BLANKSASNULL":     lambda value: value == "",
+    "EMPTYASNULL":      lambda value: value == "",
+    "ACCEPTINVCHARS":   lambda value: value == "" or (value.startswith("'") and value.endswith("'")),
+}
+
+
+def copy_profiles():
+    """ Names of the COPY profiles defined in dwh.cfg
+    """
+    return [section[len("COPY_PROFILE:"):] for section in dwh_config.sections()
+            if section.startswith("COPY_PROFILE:")]
+
+
+def copy_profile(name):
+    """ Read the options of a named COPY profile, i.e. the
+        [COPY_PROFILE:<name>] section of dwh.cfg
+
+        Returns a list of (option, value), value is empty for flags
+    """
+    section = "COPY_PROFILE:" + name
+    if not dwh_config.has_section(section):
+        raise ValueError(f"Unknown COPY profile {name}, choose from {copy_profiles()}")
 
-staging_events_copy = ("""
-    COPY staging_events FROM 's3://udacity-dend/log_data' 
-    credentials 'aws_iam_role={}'
-    json 's3://jazra.udacity.dataengineer/events.jsonpaths'
-    region 'us-west-2';
-""").format(ROLE_ARN)
+    options = []
+    for option, value in dwh_config.items(section):
+        option = option.upper()
+        if option not in COPY_OPTIONS:
+            raise ValueError(f"Unsupported COPY option {option} in profile {name}")
+        if not COPY_OPTIONS[option](value):
+            raise ValueError(f"Invalid value '{value}' for COPY option {option} in profile {name}")
+        options.append((option, value))
+    return options
 
-staging_songs_copy = ("""
-    COPY staging_songs FROM 's3://udacity-dend/song_data' 
-    credentials 'aws_iam_role={}'
-    json 'auto'
-    region 'us-west-2';
-""").format(ROLE_ARN)
+
+def copy_query(table, source, json_format, profile=COPY_PROFILE, manifest=False):
+    """ Render the COPY of json files from S3 into a table with
+        the options of a COPY profile. With `manifest`, source is
+        the S3 location of a manifest listing the files to load.
+    """
+    lines = [
+        "COPY {} FROM '{}' ".format(table, source),
+        "credentials 'aws_iam_role={}'".format(ROLE_ARN),
+        "json '{}'".format(json_format),
+        "region 'us-west-2'",
+    ]
+    if manifest:
+        lines.append("manifest")
+    lines += [" ".join((option, value)).strip() for option, value in copy_profile(profile)]
+
+    return "\n    " + "\n    ".join(lines) + ";\n"
+
+
+staging_events_copy = copy_query("staging_events", "s3://udacity-dend/log_data", EVENTS_JSONPATHS_URL)
+
+staging_songs_copy = copy_query("staging_songs", "s3://udacity-dend/song_data", "auto")
+
+# COPY of the event files that passed the validation, listed in its manifest
+staging_events_manifest_copy = copy_query("staging_events",
+                                          dwh_config.get("VALIDATION", "MANIFEST", fallback=""),
+                                          EVENTS_JSONPATHS_URL,
+                                          manifest=True)
 
 # FINAL TABLES
 
@@ -157,7 +258,9 @@ songplay_table_insert = ("""
 
 """)
 
-user_table_insert = ("""
+# the users are built from the latest event of each user in the given
+# events source (staging_events, or the union of the backfill shards)
+user_table_insert_template = ("""
     INSERT INTO users
     WITH numbered_levels AS (
       SELECT ROW_NUMBER() over (PARTITION by userId ORDER BY ts DESC) AS row_num,
@@ -166,13 +269,15 @@ user_table_insert = ("""
              lastName, 
              gender, 
              level
-        FROM staging_events
+        FROM {}
     )
     SELECT DISTINCT user_id, firstName, lastName, gender, level
       FROM numbered_levels
      WHERE row_num = 1
 """)
 
+user_table_insert = user_table_insert_template.format("staging_events")
+
 song_table_insert = ("""
     INSERT INTO songs 
     SELECT distinct song_id,
@@ -207,6 +312,281 @@ time_table_insert = ("""
 """)
 
 
+# songplay pre-joined with the dimensions, between the tables of the given
+# suffix: "" for the live tables, "_shadow" for the shadow tables
+songplay_wide_insert_template = ("""
+    INSERT INTO songplay_wide{0}
+    SELECT sp.songplay_id,
+           sp.start_time,
+           t.hour,
+           t.day,
+           t.week,
+           t.month,
+           t.year,
+           t.weekday,
+           sp.user_id,
+           u.first_name,
+           u.last_name,
+           u.gender,
+           sp.level,
+           sp.song_id,
+           s.title,
+           s.year AS song_year,
+           s.duration,
+           sp.artist_id,
+           a.name AS artist_name,
+           a.location AS artist_location,
+           a.latitude AS artist_latitude,
+           a.longitude AS artist_longitude,
+           sp.session_id,
+           sp.location,
+           sp.user_agent
+      FROM songplay{0} sp
+      LEFT JOIN time{0} t ON t.start_time = sp.start_time
+      LEFT JOIN users{0} u ON u.user_id = sp.user_id
+      LEFT JOIN songs{0} s ON s.song_id = sp.song_id
+      LEFT JOIN artists{0} a ON a.artist_id = sp.artist_id
+""")
+
+# only the songplays added since the last refresh are appended
+songplay_wide_table_insert = songplay_wide_insert_template.format("") + ("""\
+     WHERE NOT EXISTS (SELECT 1
+                         FROM songplay_wide w
+                        WHERE w.songplay_id = sp.songplay_id)
+""")
+
+# swap mode: the wide table is rebuilt from the shadow tables and swapped
+# in along with them
+songplay_wide_shadow_insert = songplay_wide_insert_template.format("_shadow")
+
+
+# INCREMENTAL (MICRO-BATCH) LOADS
+
+staging_events_insert = ("""
+    INSERT INTO staging_events (artist, auth, firstName, gender, itemInSession,
+                lastName, length, level, location, method, page, registration,
+                sessionId, song, status, ts, userAgent, userId)
+    VALUES %s
+""")
+
+# the incremental inserts take the events source as template argument,
+# and the time range to transform as query parameters
+songplay_table_incremental_insert_template = ("""
+    INSERT INTO songplay (start_time, user_id, level, song_id, 
+                artist_id, session_id, location, user_agent)
+    SELECT ts AS start_time, 
+           e.userId AS user_id, 
+           e.level AS level, 
+           s.song_id AS song_id, 
+           s.artist_id AS artist_id, 
+           e.sessionId AS session_id, 
+           e.location AS location, 
+           e.userAgent AS user_agent
+    FROM {} e
+    LEFT JOIN staging_songs s ON e.song = s.title
+            AND e.artist = s.artist_name
+            AND e.length = s.duration
+    WHERE e.page = 'NextSong'
+      AND s.song_id IS NOT NULL
+      AND s.artist_id IS NOT NULL
+      AND e.ts BETWEEN %(min_ts)s AND %(max_ts)s
+      AND NOT EXISTS (
+            SELECT 1
+              FROM songplay sp
+             WHERE sp.start_time = e.ts
+               AND sp.user_id = e.userId
+               AND sp.session_id = e.sessionId
+          )
+""")
+
+time_table_incremental_insert_template = ("""
+    INSERT INTO time 
+    SELECT DISTINCT ts AS start_time,
+           EXTRACT(hour FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS hour,
+           EXTRACT(day FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS day,
+           EXTRACT(week FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS week,
+           EXTRACT(month FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS month,
+           EXTRACT(year FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS year,
+           EXTRACT(weekday FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS weekday
+      FROM {} e
+     WHERE page = 'NextSong'
+       AND ts BETWEEN %(min_ts)s AND %(max_ts)s
+       AND NOT EXISTS (SELECT 1 FROM time t WHERE t.start_time = e.ts)
+""")
+
+songplay_table_incremental_insert = songplay_table_incremental_insert_template.format("staging_events")
+time_table_incremental_insert = time_table_incremental_insert_template.format("staging_events")
+
+# BACKFILL SHARDS
+
+staging_events_shard_create = "CREATE TABLE IF NOT EXISTS {} (LIKE staging_events)"
+staging_events_shard_drop = "DROP TABLE IF EXISTS {}"
+
+
+def staging_events_shard_copy(shard, source):
+    """ COPY the event files under the given S3 prefix into a staging shard
+    """
+    return copy_query(shard, source, EVENTS_JSONPATHS_URL)
+
+
+# A backfill is usually older than the loaded data, so only the users
+# missing from the dimension are added from their latest backfilled event
+user_table_insert_missing_template = ("""
+    INSERT INTO users
+    WITH numbered_levels AS (
+      SELECT ROW_NUMBER() over (PARTITION by userId ORDER BY ts DESC) AS row_num,
+             userId AS user_id,
+             firstName, 
+             lastName, 
+             gender, 
+             level
+        FROM {}
+    )
+    SELECT DISTINCT n.user_id, n.firstName, n.lastName, n.gender, n.level
+      FROM numbered_levels n
+     WHERE n.row_num = 1
+       AND NOT EXISTS (SELECT 1
+                         FROM users u
+                        WHERE u.user_id = n.user_id)
+""")
+
+
+# SHADOW TABLES (blue-green loads)
+
+staging_table_truncate_queries = ["TRUNCATE staging_events", "TRUNCATE staging_songs"]
+
+shadow_table_drop = "DROP TABLE IF EXISTS {}_shadow"
+old_table_drop = "DROP TABLE IF EXISTS {}_old"
+
+
+def shadow_table_create(table, identity_seed=0):
+    """ CREATE the shadow of a fact or dimension table, with the same
+        columns, keys and distribution. The songplay identity starts at
+        identity_seed, so appended songplay_ids don't collide.
+    """
+    query = dict(main_table_creates + [("songplay_wide", songplay_wide_table_create)])[table]
+    query = query.replace(f"CREATE TABLE IF NOT EXISTS {table} ", f"CREATE TABLE {table}_shadow ", 1)
+    return query.replace("IDENTITY(0, 1)", f"IDENTITY({identity_seed}, 1)")
+
+
+def shadow_insert(query):
+    """ Retarget an INSERT query from a table to its shadow table
+    """
+    table = re.match(r"\s*INSERT INTO (\w+)", query).group(1)
+    return query.replace(f"INSERT INTO {table}", f"INSERT INTO {table}_shadow", 1)
+
+
+songplay_next_id_query = "SELECT COALESCE(MAX(songplay_id), -1) + 1 FROM songplay"
+
+# before an APPEND, drop the shadow rows already in the live table
+append_dedupe_queries = {
+    "songplay": ("""
+        DELETE FROM songplay_shadow
+         USING songplay
+         WHERE songplay_shadow.start_time = songplay.start_time
+           AND songplay_shadow.user_id = songplay.user_id
+           AND songplay_shadow.session_id = songplay.session_id
+    """),
+    "songs": ("""
+        DELETE FROM songs_shadow
+         USING songs
+         WHERE songs_shadow.song_id = songs.song_id
+    """),
+    "artists": ("""
+        DELETE FROM artists_shadow
+         USING artists
+         WHERE artists_shadow.artist_id = artists.artist_id
+    """),
+    "time": ("""
+        DELETE FROM time_shadow
+         USING time
+         WHERE time_shadow.start_time = time.start_time
+    """),
+}
+
+append_table_query = "ALTER TABLE {0} APPEND FROM {0}_shadow"
+
+# The users are updated rather than appended, so that the latest level wins:
+# the live rows are replaced by the shadow ones in a single transaction.
+append_merge_queries = {
+    "users": [
+        ("""
+        DELETE FROM users
+         USING users_shadow
+         WHERE users.user_id = users_shadow.user_id
+        """),
+        ("""
+        INSERT INTO users
+        SELECT * FROM users_shadow
+        """),
+    ],
+}
+
+rename_table_query = "ALTER TABLE {} RENAME TO {}"
+table_exists_query = ("""
+    SELECT COUNT(*)
+      FROM information_schema.tables
+     WHERE table_schema = current_schema()
+       AND table_name = %s
+""")
+
+
+# MAINTENANCE
+
+table_info_query = ("""
+    SELECT "table",
+           COALESCE(unsorted, 0),
+           COALESCE(stats_off, 0),
+           COALESCE(size, 0),
+           COALESCE(tbl_rows, 0),
+           COALESCE(estimated_visible_rows, tbl_rows, 0)
+      FROM svv_table_info
+     WHERE "table" IN %s
+     ORDER BY size DESC
+""")
+
+vacuum_sort_query = "VACUUM SORT ONLY {}"
+vacuum_delete_query = "VACUUM DELETE ONLY {}"
+analyze_query = "ANALYZE {} PREDICATE COLUMNS"
+
+
+# EXPORT
+
+songplay_partitions_query = ("""
+    SELECT EXTRACT(year FROM timestamp 'epoch' + start_time/1000 * interval '1 second') AS year,
+           EXTRACT(month FROM timestamp 'epoch' + start_time/1000 * interval '1 second') AS month,
+           COUNT(*) AS cnt
+      FROM songplay
+     GROUP BY 1, 2
+     ORDER BY 1, 2
+""")
+
+songplay_partition_select = ("""
+    SELECT *
+      FROM songplay
+     WHERE EXTRACT(year FROM timestamp 'epoch' + start_time/1000 * interval '1 second') = {}
+       AND EXTRACT(month FROM timestamp 'epoch' + start_time/1000 * interval '1 second') = {}
+""")
+
+dimension_select = "SELECT * FROM {}"
+
+
+def unload_query(select, destination, max_file_size_mb):
+    """ UNLOAD the result of a query as Parquet files written in
+        parallel by the slices, along with a manifest
+    """
+    return ("""
+    UNLOAD ('{}')
+    TO '{}'
+    iam_role '{}'
+    FORMAT AS PARQUET
+    PARALLEL ON
+    MAXFILESIZE {} MB
+    MANIFEST
+    ALLOWOVERWRITE;
+""").format(select.replace("'", "''"), destination, ROLE_ARN, max_file_size_mb)
+
+
 test1 = (
 """
 WITH top_users AS (
@@ -238,10 +618,109 @@ SELECT location,
 )
 
 
+# WORKLOAD MANAGEMENT
+
+set_query_group_query = "SET query_group TO %s"
+
+# queue wait vs execution time of the queries tagged with a query group,
+# the query group being recorded as the label of the query
+wlm_report_query = ("""
+    SELECT TRIM(q.label) AS label,
+           w.service_class,
+           COUNT(*) AS queries,
+           SUM(w.total_queue_time) / 1000000.0 AS queue_s,
+           SUM(w.total_exec_time) / 1000000.0 AS exec_s,
+           MAX(w.total_queue_time) / 1000000.0 AS max_queue_s
+      FROM stl_wlm_query w
+     INNER JOIN stl_query q ON q.query = w.query
+     WHERE q.label LIKE %(etl)s
+        OR q.label LIKE %(analytics)s
+     GROUP BY 1, 2
+     ORDER BY queue_s DESC
+""")
+
+
+# BENCHMARK: the same analytic question on the star schema and the wide table
+
+wide_benchmark_queries = [
+    ("top_artists",
+     """
+     SELECT a.name, COUNT(*) AS cnt
+       FROM songplay sp
+      INNER JOIN artists a ON a.artist_id = sp.artist_id
+      GROUP BY a.name
+      ORDER BY cnt DESC
+      LIMIT 10
+     """,
+     """
+     SELECT artist_name, COUNT(*) AS cnt
+       FROM songplay_wide
+      GROUP BY artist_name
+      ORDER BY cnt DESC
+      LIMIT 10
+     """),
+    ("plays_per_hour_and_level",
+     """
+     SELECT t.hour, sp.level, COUNT(*) AS cnt
+       FROM songplay sp
+      INNER JOIN time t ON t.start_time = sp.start_time
+      GROUP BY t.hour, sp.level
+      ORDER BY t.hour, sp.level
+     """,
+     """
+     SELECT hour, level, COUNT(*) AS cnt
+       FROM songplay_wide
+      GROUP BY hour, level
+      ORDER BY hour, level
+     """),
+    ("top_songs_per_gender",
+     """
+     SELECT u.gender, s.title, COUNT(*) AS cnt
+       FROM songplay sp
+      INNER JOIN users u ON u.user_id = sp.user_id
+      INNER JOIN songs s ON s.song_id = sp.song_id
+      GROUP BY u.gender, s.title
+      ORDER BY cnt DESC
+      LIMIT 10
+     """,
+     """
+     SELECT gender, title, COUNT(*) AS cnt
+       FROM songplay_wide
+      GROUP BY gender, title
+      ORDER BY cnt DESC
+      LIMIT 10
+     """),
+]
+
+
 # QUERY LISTS
 
 create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, songplay_wide_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
 insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
 tests_queries = [test1, test2]
+maintained_tables = ["songplay", "users", "songs", "artists", "time", "songplay_wide"]
+dimension_tables = ["users", "songs", "artists", "time"]
+main_table_creates = [
+    ("songplay", songplay_table_create),
+    ("users", user_table_create),
+    ("songs", song_table_create),
+    ("artists", artist_table_create),
+    ("time", time_table_create),
+]
+incremental_insert_queries = [songplay_table_incremental_insert, time_table_incremental_insert]
+
+# NAMED STAGES (used by the ETL run-state checkpoints)
+
+copy_table_stages = [
+    ("staging_events_copy", staging_events_copy),
+    ("staging_songs_copy", staging_songs_copy),
+]
+insert_table_stages = [
+    ("songplay_table_insert", songplay_table_insert),
+    ("user_table_insert", user_table_insert),
+    ("song_table_insert", song_table_insert),
+    ("artist_table_insert", artist_table_insert),
+    ("time_table_insert", time_table_insert),
+]
@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import shutil
+import time
+
+import psycopg2.extras
+
+from create_tables import jsonpath_keys
+from etl import setup_db_connection, set_query_group
+from sql_queries import (
+    staging_events_insert,
+    incremental_insert_queries,
+    ETL_QUERY_GROUP,
+)
+
+EVENT_KEYS = jsonpath_keys()
+
+
+def initialize_config(config_file):
+    """ Read the [STREAM] section of the project configuration
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    return {
+        "LANDING_DIR":          config.get("STREAM", "LANDING_DIR"),
+        "MAX_BATCH_EVENTS":     config.getint("STREAM", "MAX_BATCH_EVENTS"),
+        "MAX_BATCH_AGE_S":      config.getfloat("STREAM", "MAX_BATCH_AGE_S"),
+        "POLL_INTERVAL_S":      config.getfloat("STREAM", "POLL_INTERVAL_S"),
+        "MAX_PENDING_BATCHES":  config.getint("STREAM", "MAX_PENDING_BATCHES"),
+    }
+
+
+def read_events(path):
+    """ Read a file of json events (one event per line) into rows
+        ordered as the staging_events columns.
+
+        Args:
+        * path: the path of the event file
+    """
+    rows = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            rows.append(tuple(event.get(key) for key in EVENT_KEYS))
+    return rows
+
+
+def new_batch():
+    """ Create an empty micro-batch
+    """
+    return {"rows": [], "files": [], "opened_at": time.time()}
+
+
+def load_batch(conn, batch):
+    """ Insert a micro-batch into staging_events and run the incremental
+        songplay/time transform over its time range, in one transaction.
+
+        Args:
+        * conn: the connection to the db, not in autocommit mode
+        * batch: the micro-batch to load
+    """
+    ts = [row[EVENT_KEYS.index("ts")] for row in batch["rows"]]
+    ts = [value for value in ts if value is not None]
+
+    try:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur,
+                                           staging_events_insert,
+                                           batch["rows"],
+                                           page_size=1000)
+            if ts:
+                params = {"min_ts": min(ts), "max_ts": max(ts)}
+                for query in incremental_insert_queries:
+                    cur.execute(query, params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def move_files(files, landing_dir, subdir):
+    """ Move the files of a batch out of the landing directory
+
+        Args:
+        * files: list of (path, arrival time) of the batch
+        * landing_dir: the landing directory
+        * subdir: the destination sub-directory, e.g. processed
+    """
+    target = os.path.join(landing_dir, subdir)
+    os.makedirs(target, exist_ok=True)
+    for path, _ in files:
+        shutil.move(path, os.path.join(target, os.path.basename(path)))
+
+
+async def watch_landing_dir(CFG, queue, once=False):
+    """ Poll the landing directory for new event files and group them
+        into micro-batches bounded by number of events and age.
+        Blocks on a full queue, which applies backpressure to the watcher.
+        A file is only picked up once it hasn't been modified for
+        POLL_INTERVAL_S, so files still being written are left alone;
+        writers can also write to a .tmp name and rename it when done.
+
+        Args:
+        * CFG: the stream configuration
+        * queue: the asyncio queue of batches waiting to be loaded
+        * once: stop after the files currently in the directory are queued
+    """
+    landing_dir = CFG["LANDING_DIR"]
+    seen = set()
+    batch = new_batch()
+
+    async def flush():
+        nonlocal batch
+        if not batch["rows"]:
+            return
+        if queue.full():
+            print(f"Backpressure: {queue.qsize()} batches pending, waiting for the loader")
+        await queue.put(batch)
+        batch = new_batch()
+
+    while True:
+        paths = sorted(os.path.join(landing_dir, name)
+                       for name in os.listdir(landing_dir)
+                       if name.endswith(".json"))
+        unsettled = 0
+
+        for path in paths:
+            if path in seen:
+                continue
+            if time.time() - os.path.getmtime(path) < CFG["POLL_INTERVAL_S"]:
+                unsettled += 1
+                continue
+            seen.add(path)
+
+            try:
+                rows = read_events(path)
+            except Exception as e:
+                print(f"Rejecting {path}: {e}")
+                move_files([(path, None)], landing_dir, "failed")
+                continue
+
+            if not rows:
+                move_files([(path, None)], landing_dir, "processed")
+                continue
+
+            if not batch["rows"]:
+                batch["opened_at"] = time.time()
+            batch["rows"].extend(rows)
+            batch["files"].append((path, os.path.getmtime(path)))
+
+            if len(batch["rows"]) >= CFG["MAX_BATCH_EVENTS"]:
+                await flush()
+
+        if once and not unsettled:
+            await flush()
+            await queue.put(None)
+            return
+
+        if time.time() - batch["opened_at"] >= CFG["MAX_BATCH_AGE_S"]:
+            await flush()
+
+        await asyncio.sleep(CFG["POLL_INTERVAL_S"])
+
+
+async def load_batches(CFG, conn, queue):
+    """ Load the queued micro-batches one at a time and report the load
+        throughput and the end-to-end latency from file arrival to commit.
+
+        Args:
+        * CFG: the stream configuration
+        * conn: the connection to the db, not in autocommit mode
+        * queue: the asyncio queue of batches waiting to be loaded
+    """
+    loop = asyncio.get_running_loop()
+
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            return
+
+        started = time.time()
+        try:
+            await loop.run_in_executor(None, load_batch, conn, batch)
+        except Exception as e:
+            print(f"Batch of {len(batch['files'])} files failed: {e}")
+            move_files(batch["files"], CFG["LANDING_DIR"], "failed")
+            continue
+
+        committed = time.time()
+        move_files(batch["files"], CFG["LANDING_DIR"], "processed")
+
+        latencies = sorted(committed - arrival for _, arrival in batch["files"])
+        load_s = committed - started
+        print(f"Loaded {len(batch['rows'])} events from {len(batch['files'])} files "
+              f"in {load_s:.2f}s ({len(batch['rows']) / max(load_s, 1e-6):.0f} events/s), "
+              f"latency p50={latencies[len(latencies) // 2]:.2f}s max={latencies[-1]:.2f}s, "
+              f"{queue.qsize()} batches pending")
+
+
+async def run(CFG, conn, once=False):
+    """ Run the watcher and the loader concurrently
+
+        Args:
+        * CFG: the stream configuration
+        * conn: the connection to the db, not in autocommit mode
+        * once: stop after the files currently in the directory are loaded
+    """
+    queue = asyncio.Queue(maxsize=CFG["MAX_PENDING_BATCHES"])
+    await asyncio.gather(watch_landing_dir(CFG, queue, once=once),
+                         load_batches(CFG, conn, queue))
+
+
+def argparser():
+    """ Command Line parser for the script
+    """
+
+    parser = argparse.ArgumentParser(description='Micro-batch ingestion of event files')
+    parser.add_argument('--once',
+                        action='store_true',
+                        help='load the files currently in the landing directory and exit'
+                        )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """ Main entrypoint for the script
+    """
+    args = argparser()
+    CFG = initialize_config('dwh.cfg')
+    os.makedirs(CFG["LANDING_DIR"], exist_ok=True)
+
+    conn = setup_db_connection()
+    set_query_group(conn.cursor(), ETL_QUERY_GROUP, "stream")
+    conn.set_session(autocommit=False)
+
+    print(f"=== Watching {CFG['LANDING_DIR']}...")
+    try:
+        asyncio.run(run(CFG, conn, once=args.once))
+    except KeyboardInterrupt:
+        print("Stopping...")
+
+    conn.close()
+    print("Done!")
+
+if __name__ == "__main__":
+    main()
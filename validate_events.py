@@ -0,0 +1,252 @@
+import configparser
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from create_tables import jsonpath_keys
+from s3_utils import s3_client, split_s3_url
+
+# Expected json types of the staging_events columns, and the maximum
+# length of the VARCHAR columns
+INTEGER_KEYS = ("itemInSession", "sessionId", "status", "ts")
+NUMBER_KEYS = ("length", "registration")
+MAX_LENGTH = {"userAgent": 65535}
+DEFAULT_MAX_LENGTH = 1024
+
+EVENT_KEYS = jsonpath_keys()
+
+# boto3 client of each worker process, only used for S3 sources
+s3 = None
+
+
+def initialize_config(config_file, credentials_file):
+    """ Read the validation configuration and AWS credentials
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    credentials = configparser.ConfigParser()
+    credentials.read(credentials_file)
+
+    return {
+        "KEY":          credentials.get("AWS", "KEY"),
+        "SECRET":       credentials.get("AWS", "SECRET"),
+        "LOG_DATA":     config.get("S3", "LOG_DATA").strip("'"),
+        "ENABLED":      config.getboolean("VALIDATION", "ENABLED"),
+        "SOURCE":       config.get("VALIDATION", "SOURCE").rstrip("/"),
+        "MANIFEST":     config.get("VALIDATION", "MANIFEST"),
+        "QUARANTINE":   config.get("VALIDATION", "QUARANTINE"),
+        "WORKERS":      config.getint("VALIDATION", "WORKERS"),
+    }
+
+
+def list_source_files(CFG):
+    """ List the json event files of the source, either an S3 prefix
+        or a local directory
+    """
+    source = CFG["SOURCE"]
+
+    if source.startswith("s3://"):
+        bucket, prefix = split_s3_url(source)
+        paginator = s3_client(CFG).get_paginator("list_objects_v2")
+        return [f"s3://{bucket}/{obj['Key']}"
+                for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+                for obj in page.get("Contents", [])
+                if obj["Key"].endswith(".json")]
+
+    return sorted(os.path.join(root, name)
+                  for root, _, names in os.walk(source)
+                  for name in names
+                  if name.endswith(".json"))
+
+
+def validate_event(event):
+    """ Check one event against the staging_events columns. Only what the
+        jsonpaths COPY would reject is an error: the keys that aren't in the
+        jsonpaths are ignored by the COPY.
+
+        Returns the list of problems found
+    """
+    if not isinstance(event, dict):
+        return ["event is not a json object"]
+
+    errors = []
+
+    for key in EVENT_KEYS:
+        value = event.get(key)
+        if value is None:
+            continue
+
+        if key in INTEGER_KEYS:
+            if not isinstance(value, int) or isinstance(value, bool):
+                errors.append(f"{key} is not an integer: {value!r}")
+        elif key in NUMBER_KEYS:
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                errors.append(f"{key} is not a number: {value!r}")
+        elif not isinstance(value, str):
+            errors.append(f"{key} is not a string: {value!r}")
+        elif len(value.encode("utf-8")) > MAX_LENGTH.get(key, DEFAULT_MAX_LENGTH):
+            errors.append(f"{key} is too long")
+
+    if event.get("ts") is None:
+        errors.append("ts is missing")
+
+    return errors
+
+
+def init_worker(CFG):
+    """ Create the S3 client of a worker process
+    """
+    global s3
+    if CFG["SOURCE"].startswith("s3://"):
+        s3 = s3_client(CFG)
+
+
+def validate_file(path):
+    """ Validate every event of a file. Runs in a worker process.
+
+        Args:
+        * path: S3 url or local path of the file
+
+        Returns (path, errors, warnings, number of events, size in bytes,
+        duration in seconds)
+    """
+    started = time.time()
+
+    if path.startswith("s3://"):
+        bucket, key = split_s3_url(path)
+        content = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    else:
+        with open(path, "rb") as f:
+            content = f.read()
+
+    # COPY rejects the whole load on invalid UTF-8, so the file is rejected as well
+    try:
+        text = content.decode("utf-8")
+    except UnicodeDecodeError as e:
+        return path, [f"invalid utf-8: {e}"], [], 0, len(content), time.time() - started
+
+    errors = []
+    extra_keys = set()
+    events = 0
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        events += 1
+        try:
+            event = json.loads(line)
+        except ValueError as e:
+            errors.append(f"line {number}: invalid json: {e}")
+            continue
+        errors += [f"line {number}: {problem}" for problem in validate_event(event)]
+        if isinstance(event, dict):
+            extra_keys.update(key for key in event if key not in EVENT_KEYS)
+
+    warnings = [f"unexpected key {key}, ignored by the COPY" for key in sorted(extra_keys)]
+
+    return path, errors, warnings, events, len(content), time.time() - started
+
+
+def source_url(CFG, path):
+    """ S3 url of a validated file. Local sources are a mirror of the
+        log_data prefix, so their relative path is appended to it.
+    """
+    if path.startswith("s3://"):
+        return path
+    return CFG["LOG_DATA"] + "/" + os.path.relpath(path, CFG["SOURCE"]).replace(os.sep, "/")
+
+
+def quarantine(CFG, rejects):
+    """ Record the rejected files with their reasons in the quarantine
+        directory. Local files are moved into it.
+
+        Args:
+        * CFG: the validation configuration
+        * rejects: dictionary of file -> list of errors
+    """
+    os.makedirs(CFG["QUARANTINE"], exist_ok=True)
+
+    for path in rejects:
+        if not path.startswith("s3://"):
+            target = os.path.join(CFG["QUARANTINE"], os.path.relpath(path, CFG["SOURCE"]))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(path, target)
+
+    with open(os.path.join(CFG["QUARANTINE"], "rejects.json"), "w") as f:
+        json.dump(rejects, f, indent=2)
+
+
+def write_manifest(CFG, urls):
+    """ Upload the COPY manifest listing the valid files
+
+        Args:
+        * CFG: the validation configuration
+        * urls: S3 urls of the files to load
+    """
+    manifest = {"entries": [{"url": url, "mandatory": True} for url in urls]}
+    bucket, key = split_s3_url(CFG["MANIFEST"])
+    s3_client(CFG).put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode("utf-8"))
+
+
+def validate_events(CFG):
+    """ Validate the event files in parallel, quarantine the bad ones and
+        write the manifest of the good ones used by the staging_events COPY.
+        Fails when no file is valid, rather than loading an empty manifest.
+
+        Args:
+        * CFG: the validation configuration
+
+        Returns the number of rejected files
+    """
+    print("=== Validating event files...")
+    started = time.time()
+
+    files = list_source_files(CFG)
+    with ProcessPoolExecutor(max_workers=CFG["WORKERS"],
+                             initializer=init_worker,
+                             initargs=(CFG,)) as executor:
+        results = list(executor.map(validate_file, files, chunksize=8))
+
+    elapsed = time.time() - started
+    rejects = {path: errors for path, errors, _, _, _, _ in results if errors}
+    valid = [source_url(CFG, path) for path, errors, _, _, _, _ in results if not errors]
+
+    for path, _, warnings, _, _, _ in results:
+        for warning in warnings:
+            print(f"Warning {path}: {warning}")
+
+    if rejects:
+        quarantine(CFG, rejects)
+        for path, errors in rejects.items():
+            print(f"Quarantined {path}: {errors[0]} ({len(errors)} errors)")
+
+    report = pd.DataFrame([(path, events, size, duration) for path, _, _, events, size, duration in results],
+                          columns=["file", "events", "bytes", "duration_s"])
+    print(report.sort_values("duration_s", ascending=False).head(10))
+    print(f"{len(valid)} valid / {len(rejects)} rejected files, "
+          f"{report['events'].sum()} events, {report['bytes'].sum() / 1e6:.1f} MB "
+          f"in {elapsed:.1f}s ({len(files) / max(elapsed, 1e-6):.1f} files/s, "
+          f"{report['bytes'].sum() / 1e6 / max(elapsed, 1e-6):.1f} MB/s)")
+
+    if not valid:
+        raise ValueError(f"No valid event file in {CFG['SOURCE']} "
+                         f"({len(rejects)} rejected), nothing to load")
+
+    write_manifest(CFG, valid)
+
+    return len(rejects)
+
+
+def main():
+    """ Main entrypoint for the script
+    """
+    CFG = initialize_config('dwh.cfg', 'aws.cfg')
+    validate_events(CFG)
+    print("Done!")
+
+if __name__ == "__main__":
+    main()